@@ -5,87 +5,368 @@ Processes user responses from Slack and updates YNAB transactions
 """
 
 import os
-import json
+import orjson
 import requests
 import re
-from typing import Dict, List
+import atexit
+import functools
+import hashlib
+import hmac
+import tempfile
+import time
+import threading
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
+from rapidfuzz import fuzz, process
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from ynab_state import (
+    JOURNAL_FILE, MAX_PROCESSED, STATE_FILE, apply_journal_entry, index_pending_transactions,
+    merge_category_groups, prune_pending, read_journal, read_pending_batch
+)
 
 # Configuration
 YNAB_API_TOKEN = os.getenv("YNAB_API_TOKEN")
 YNAB_BUDGET_ID = os.getenv("YNAB_BUDGET_ID", "last-used")
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 SLACK_SIGNING_SECRET = os.getenv("SLACK_SIGNING_SECRET")
-STATE_FILE = "/tmp/ynab_agent_state.json"
+# Fold the journal back into STATE_FILE after this many entries
+SNAPSHOT_EVERY = 100
+# How long (seconds) cached YNAB categories are trusted before re-fetching;
+# a stale copy is also refreshed early when a category can't be found or is rejected
+CATEGORY_CACHE_TTL = 86400
+# Minimum gap (seconds) between those early refreshes
+CATEGORY_REFRESH_MIN_INTERVAL = 60
+# Approval command patterns: "approve 1,3,5" and "1: Groceries"
+NUMBERS_RE = re.compile(r'\d+')
+CHANGE_CATEGORY_RE = re.compile(r'(\d+)\s*:\s*(.+)')
+# Minimum rapidfuzz score (0-100) for a typed category to match a YNAB category
+FUZZY_MATCH_CUTOFF = 70
+# Slack requests signed longer ago than this (seconds) are rejected as replays
+SLACK_SIGNATURE_MAX_AGE = 300
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, used by request.json and jsonify"""
+    
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+
+def make_session(headers: Dict[str, str]) -> requests.Session:
+    """Create a keep-alive session with pooled connections, retries on transient errors, and default headers"""
+    session = requests.Session()
+    session.headers.update(headers)
+    retries = Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False
+    )
+    session.mount("https://", HTTPAdapter(pool_maxsize=20, max_retries=retries))
+    return session
+
+
+# Keyed once; each request verifies against a copy instead of re-keying
+SLACK_SIGNER = hmac.new(SLACK_SIGNING_SECRET.encode(), digestmod=hashlib.sha256) if SLACK_SIGNING_SECRET else None
+
+# Shared by every Slack API call so replies reuse one TLS connection
+SLACK_SESSION = make_session({
+    "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
+    "Content-Type": "application/json"
+})
+
+# Slack wants an ACK within 3 seconds, so event handling runs on this pool instead
+executor = ThreadPoolExecutor(max_workers=4)
+
+# Most recent Slack event ids, used to drop Slack's automatic retries
+SEEN_EVENTS_MAX = 1024
+seen_events = OrderedDict()
+seen_events_lock = threading.Lock()
+
+
+def post_to_slack(method: str, payload: Dict):
+    """Call a Slack Web API method (e.g. chat.postMessage) over the shared session"""
+    SLACK_SESSION.post(f"https://slack.com/api/{method}", json=payload)
+
+
+def synchronized(method):
+    """Run a handler method while holding the handler's lock"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class ApprovalHandler:
     def __init__(self):
-        self.ynab_headers = {
+        # Guards the state against concurrent Slack events
+        self.lock = threading.RLock()
+        self.session = make_session({
             "Authorization": f"Bearer {YNAB_API_TOKEN}",
             "Content-Type": "application/json"
-        }
+        })
         self.state = self.load_state()
+        self.processed_queue = deque(self.state["processed_transactions"], maxlen=MAX_PROCESSED)
+        self.processed_ids = set(self.processed_queue)
+        self.state["processed_transactions"] = self.processed_queue
+        self.journal_entries = self.replay_journal()
+        self.journal = open(JOURNAL_FILE, 'ab', buffering=0)
+        # Entries recorded since the last flush(), written to the journal together
+        self.journal_buffer = []
         self.categories = self.get_categories()
-        self.category_name_to_id = {v: k for k, v in self.categories.items()}
+        self.index_categories()
+        # Only a fully built handler may snapshot at exit: get_handler() retries a failed one,
+        # and a stale copy would overwrite the live handler's state and truncate its journal
+        atexit.register(self.compact)
     
     def load_state(self) -> Dict:
         """Load agent state"""
         if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                return json.load(f)
-        return {"processed_transactions": [], "category_patterns": {}}
+            with open(STATE_FILE, 'rb') as f:
+                state = orjson.loads(f.read())
+            index_pending_transactions(state)
+            return state
+        return {"processed_transactions": [], "category_patterns": {}, "pending": {}}
+    
+    def replay_journal(self) -> int:
+        """Apply changes journaled since the last snapshot, returning how many there were"""
+        count = 0
+        for entry in read_journal():
+            self.apply(entry)
+            count += 1
+        return count
+    
+    def apply(self, entry: Dict):
+        """Apply a journal entry to the in-memory state"""
+        # processed_transactions is a bounded deque here, kept in step with processed_ids
+        if entry["op"] == "processed":
+            for tid in entry["ids"]:
+                self.mark_processed(tid)
+        else:
+            apply_journal_entry(self.state, entry)
+    
+    def mark_processed(self, transaction_id: str):
+        """Remember a processed id, forgetting the oldest once MAX_PROCESSED are kept"""
+        if transaction_id in self.processed_ids:
+            return
+        if len(self.processed_queue) == MAX_PROCESSED:
+            self.processed_ids.discard(self.processed_queue[0])
+        self.processed_queue.append(transaction_id)
+        self.processed_ids.add(transaction_id)
     
+    def record(self, op: str, **fields):
+        """Apply a state change in memory and stage it for the next flush()"""
+        entry = {"op": op, **fields}
+        self.apply(entry)
+        self.journal_buffer.append(orjson.dumps(entry) + b"\n")
+    
+    def flush(self):
+        """Append every staged change to the journal in a single write"""
+        if not self.journal_buffer:
+            return
+        self.journal.write(b"".join(self.journal_buffer))
+        self.journal_entries += len(self.journal_buffer)
+        self.journal_buffer.clear()
+        if self.journal_entries >= SNAPSHOT_EVERY:
+            self.save_state()
+    
+    @synchronized
+    def compact(self):
+        """Fold any journaled or staged changes into a fresh snapshot"""
+        if self.journal_entries or self.journal_buffer:
+            self.save_state()
+    
+    @synchronized
     def save_state(self):
-        """Save agent state"""
-        with open(STATE_FILE, 'w') as f:
-            json.dump(self.state, f, indent=2)
+        """
+        Atomically write a full snapshot of the state and start a new journal.
+        Only one process may do this: the Procfile runs a single gunicorn worker.
+        """
+        prune_pending(self.state)
+        data = orjson.dumps({**self.state, "processed_transactions": list(self.processed_queue)})
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(STATE_FILE))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            # Readers see either the old or the new file, never a truncated one
+            os.replace(tmp_path, STATE_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.journal.truncate(0)
+        # The snapshot already includes anything still staged
+        self.journal_buffer.clear()
+        self.journal_entries = 0
     
-    def get_categories(self) -> Dict[str, str]:
-        """Fetch categories from YNAB"""
+    def get_categories(self, force: bool = False) -> Dict[str, str]:
+        """
+        Fetch categories from YNAB, reusing the cached copy in the state while it is fresh.
+        Once stale, only the changes since the cached copy's server_knowledge are requested.
+        """
+        cached = self.state.get("ynab_cache", {}).get("categories")
+        if cached and not force and time.time() - cached["fetched_at"] < CATEGORY_CACHE_TTL:
+            return cached["data"]
+        
         url = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/categories"
-        response = requests.get(url, headers=self.ynab_headers)
+        categories, params = {}, {}
+        if cached and "server_knowledge" in cached:
+            categories = dict(cached["data"])
+            params["last_knowledge_of_server"] = cached["server_knowledge"]
+        
+        response = self.session.get(url, params=params)
         response.raise_for_status()
+        data = orjson.loads(response.content)["data"]
+        
+        merge_category_groups(categories, data["category_groups"])
         
-        categories = {}
-        for group in response.json()["data"]["category_groups"]:
-            if group["name"] in ["Internal Master Category", "Hidden Categories"]:
-                continue
-            for cat in group["categories"]:
-                if not cat["hidden"] and not cat["deleted"]:
-                    categories[cat["id"]] = cat["name"]
+        self.record("cache", key="categories", value={
+            "data": categories,
+            "fetched_at": time.time(),
+            "server_knowledge": data["server_knowledge"]
+        })
+        self.flush()
         return categories
     
-    def find_pending_transactions(self, thread_ts: str) -> List[Dict]:
-        """Find pending transactions by thread timestamp"""
-        pending_key = f"pending_{thread_ts}"
-        if pending_key in self.state:
-            return self.state[pending_key]["transactions"]
+    def refresh_categories(self) -> bool:
+        """Re-fetch categories ahead of the TTL, returning False if they were fetched too recently or YNAB is unreachable"""
+        fetched_at = self.state["ynab_cache"]["categories"]["fetched_at"]
+        if time.time() - fetched_at < CATEGORY_REFRESH_MIN_INTERVAL:
+            return False
+        try:
+            self.categories = self.get_categories(force=True)
+        except requests.RequestException as e:
+            # Callers fall back to their usual failure reply
+            print(f"❌ Error refreshing categories: {e}")
+            return False
+        self.index_categories()
+        return True
+    
+    def index_categories(self):
+        """Build the lookup tables used to resolve category names typed in Slack"""
+        self.category_name_to_id = {v: k for k, v in self.categories.items()}
+        self.category_lower_to_name = {name.lower(): name for name in self.category_name_to_id}
+    
+    def find_category(self, name: str) -> Optional[str]:
+        """Resolve a typed category name: exact (case-insensitive) match first, then fuzzy"""
+        query = name.lower()
+        matched = self.category_lower_to_name.get(query)
+        if matched:
+            return matched
+        
+        # Substrings score 100 with partial_ratio; small typos still clear the cutoff
+        hit = process.extractOne(
+            query,
+            self.category_lower_to_name.keys(),
+            scorer=fuzz.partial_ratio,
+            score_cutoff=FUZZY_MATCH_CUTOFF
+        )
+        return self.category_lower_to_name[hit[0]] if hit else None
+    
+    def find_pending_transactions(self, thread_ts: str) -> Optional[List[Tuple[int, Dict]]]:
+        """Find pending transactions by thread timestamp, each with its row number as posted, leaving out those already resolved"""
+        pending = self.state["pending"].get(thread_ts)
+        if pending:
+            resolved = set(pending["resolved"])
+            transactions = read_pending_batch(pending["file"])["transactions"]
+            return [(num, txn) for num, (tid, txn) in enumerate(transactions.items(), 1) if tid not in resolved]
         return None
     
+    def find_pending_transaction(self, thread_ts: str, txn_id: str) -> Optional[Tuple[int, Dict]]:
+        """Row number (as posted) and transaction for `txn_id`, or None if its batch is gone or it was already resolved"""
+        pending = self.state["pending"].get(thread_ts)
+        if not pending:
+            return None
+        transactions = read_pending_batch(pending["file"])["transactions"]
+        if txn_id not in transactions and txn_id.isdigit() and 1 <= int(txn_id) <= len(transactions):
+            # Buttons posted before they carried ids hold the row number instead
+            txn_id = list(transactions)[int(txn_id) - 1]
+        if txn_id not in transactions or txn_id in pending["resolved"]:
+            return None
+        return list(transactions).index(txn_id) + 1, transactions[txn_id]
+    
+    def count_pending_transactions(self, thread_ts: str) -> int:
+        """Number of transactions still awaiting approval in a batch"""
+        pending = self.state["pending"].get(thread_ts)
+        return pending["count"] - len(pending["resolved"]) if pending else 0
+    
     def update_ynab_transaction(self, transaction_id: str, category_name: str) -> bool:
         """Update a transaction's category in YNAB and mark as approved"""
+        update = self.build_category_update(transaction_id, category_name)
+        if update and self.patch_ynab_transaction(update):
+            return True
+        
+        # The cached category may have been renamed or deleted; retry once if a refresh changes it
+        if self.refresh_categories():
+            retry = self.build_category_update(transaction_id, category_name)
+            if retry and retry != update:
+                return self.patch_ynab_transaction(retry)
+        return False
+    
+    def patch_ynab_transaction(self, update: Dict) -> bool:
+        """PATCH a single transaction; `update` holds the transaction id plus the fields to change"""
+        fields = {k: v for k, v in update.items() if k != "id"}
+        url = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/transactions/{update['id']}"
+        response = self.session.patch(url, json={"transaction": fields})
+        return response.status_code == 200
+    
+    def update_ynab_transactions_bulk(self, updates: List[Dict]) -> Set[str]:
+        """Update many transactions with a single PATCH, returning the ids YNAB saved"""
+        if not updates:
+            return set()
+        
+        url = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/transactions"
+        response = self.session.patch(url, json={"transactions": updates})
+        # YNAB answers a bulk update with 209 rather than 200
+        if response.ok:
+            return {txn["id"] for txn in orjson.loads(response.content)["data"]["transactions"]}
+        
+        # Bulk endpoint failed - fall back to one PATCH per transaction
+        return {update["id"] for update in updates if self.patch_ynab_transaction(update)}
+    
+    def build_suggested_updates(self, transactions: List[Dict]) -> List[Optional[Dict]]:
+        """
+        Build the update approving each transaction's suggested category (None where it is unknown).
+        If any is unknown, categories are refreshed once, since the agent may know newer ones.
+        """
+        updates = [self.build_category_update(txn["id"], txn["suggested_category"]) for txn in transactions]
+        if None in updates and self.refresh_categories():
+            updates = [self.build_category_update(txn["id"], txn["suggested_category"]) for txn in transactions]
+        return updates
+    
+    def build_category_update(self, transaction_id: str, category_name: str) -> Optional[Dict]:
+        """Build the update that sets a transaction's category and approves it"""
         category_id = self.category_name_to_id.get(category_name)
         if not category_id:
-            return False
-        
-        url = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/transactions/{transaction_id}"
-        response = requests.patch(
-            url,
-            headers=self.ynab_headers,
-            json={"transaction": {"category_id": category_id, "approved": True}}
-        )
-        return response.status_code == 200
+            return None
+        return {"id": transaction_id, "category_id": category_id, "approved": True}
     
     def learn_pattern(self, payee_name: str, category: str):
-        """Learn a merchant -> category pattern"""
-        # Normalize payee name
-        normalized = payee_name.lower().strip()
-        self.state["category_patterns"][normalized] = category
-        self.save_state()
+        """Learn a merchant -> category pattern (persisted on the next flush())"""
+        self.learn_patterns([(payee_name, category)])
     
+    def learn_patterns(self, pairs: List[Tuple[str, str]]):
+        """Learn several merchant -> category patterns as a single journal entry"""
+        # Normalize payee names
+        patterns = {payee_name.lower().strip(): category for payee_name, category in pairs}
+        if patterns:
+            self.record("learn", patterns=patterns)
+    
+    @synchronized
     def process_approval(self, text: str, thread_ts: str, channel: str) -> str:
         """Process user approval message"""
         transactions = self.find_pending_transactions(thread_ts)
@@ -93,7 +374,8 @@ class ApprovalHandler:
         if not transactions:
             return "❌ Could not find pending transactions. They may have already been processed."
         
-        text_lower = text.lower().strip()
+        text_stripped = text.strip()
+        text_lower = text_stripped.lower()
         
         # Handle "approve all"
         if "approve all" in text_lower:
@@ -101,12 +383,12 @@ class ApprovalHandler:
         
         # Handle "approve 1,3,5"
         if text_lower.startswith("approve "):
-            numbers = re.findall(r'\d+', text)
+            numbers = NUMBERS_RE.findall(text_stripped)
             return self.approve_specific(transactions, numbers, thread_ts, channel)
         
         # Handle "1: Groceries" (change category)
-        if ":" in text:
-            match = re.match(r'(\d+):\s*(.+)', text.strip())
+        if ":" in text_stripped:
+            match = CHANGE_CATEGORY_RE.match(text_stripped)
             if match:
                 txn_num = int(match.group(1))
                 new_category = match.group(2).strip()
@@ -118,91 +400,96 @@ class ApprovalHandler:
         
         return "🤔 I didn't understand that. Try:\n• `approve all`\n• `approve 1,3,5`\n• `1: Category Name`\n• `skip`"
     
-    def approve_all(self, transactions: List[Dict], thread_ts: str, channel: str) -> str:
+    def approve_all(self, transactions: List[Tuple[int, Dict]], thread_ts: str, channel: str) -> str:
         """Approve all suggested categorizations"""
+        updates = self.build_suggested_updates([txn for _, txn in transactions])
+        updated_ids = self.update_ynab_transactions_bulk([u for u in updates if u])
+        
         results = []
-        for i, txn in enumerate(transactions, 1):
+        approved_ids = []
+        learned = []
+        for num, txn in transactions:
             category = txn["suggested_category"]
-            success = self.update_ynab_transaction(txn["id"], category)
             
-            if success:
-                # Learn this pattern
-                self.learn_pattern(txn["payee_name"], category)
-                # Mark as processed
-                self.state["processed_transactions"].append(txn["id"])
-                results.append(f"✅ {i}. {txn['payee_name']} → {category}")
+            if txn["id"] in updated_ids:
+                learned.append((txn["payee_name"], category))
+                approved_ids.append(txn["id"])
+                results.append(f"✅ {num}. {txn['payee_name']} → {category}")
             else:
-                results.append(f"❌ {i}. {txn['payee_name']} (failed)")
-        
-        # Clean up pending transactions
-        self.state.pop(f"pending_{thread_ts}", None)
-        self.save_state()
+                results.append(f"❌ {num}. {txn['payee_name']} (failed)")
         
-        success_count = sum(1 for r in results if r.startswith("✅"))
+        # Learn these patterns, mark as processed and clean up pending transactions
+        self.learn_patterns(learned)
+        self.record("processed", ids=approved_ids)
+        self.record("drop_pending", ts=thread_ts)
+        self.flush()
         
-        message = f"*Updated {success_count}/{len(transactions)} transactions:*\n\n" + "\n".join(results)
+        message = f"*Updated {len(approved_ids)}/{len(transactions)} transactions:*\n\n" + "\n".join(results)
         return message
     
-    def approve_specific(self, transactions: List[Dict], numbers: List[str], thread_ts: str, channel: str) -> str:
-        """Approve specific transaction numbers"""
+    def approve_specific(self, transactions: List[Tuple[int, Dict]], numbers: List[str], thread_ts: str, channel: str) -> str:
+        """Approve specific transaction numbers, as posted in the Slack message"""
+        by_row = dict(transactions)
+        selected = []
+        invalid = []
+        for num_str in numbers:
+            num = int(num_str)
+            if num in by_row:
+                selected.append((num, by_row[num]))
+            else:
+                invalid.append(num)
+        
+        return self.approve_selected(selected, invalid, thread_ts)
+    
+    def approve_selected(self, selected: List[Tuple[int, Dict]], invalid: List[int], thread_ts: str) -> str:
+        """Approve the suggested category of each (row number, transaction) in `selected`"""
+        updates = self.build_suggested_updates([txn for _, txn in selected])
+        updated_ids = self.update_ynab_transactions_bulk([u for u in updates if u])
+        
         results = []
         approved_ids = []
+        learned = []
         
-        for num_str in numbers:
-            num = int(num_str)
-            if num < 1 or num > len(transactions):
-                results.append(f"❌ {num}. Invalid transaction number")
-                continue
-            
-            txn = transactions[num - 1]
+        for num, txn in selected:
             category = txn["suggested_category"]
-            success = self.update_ynab_transaction(txn["id"], category)
-            
-            if success:
-                self.learn_pattern(txn["payee_name"], category)
+            if txn["id"] in updated_ids:
+                learned.append((txn["payee_name"], category))
                 approved_ids.append(txn["id"])
                 results.append(f"✅ {num}. {txn['payee_name']} → {category}")
             else:
                 results.append(f"❌ {num}. {txn['payee_name']} (failed)")
+        results.extend(f"❌ {num}. Invalid or already approved transaction number" for num in invalid)
         
-        # Mark approved as processed
-        self.state["processed_transactions"].extend(approved_ids)
+        # Learn approved patterns and mark them as processed
+        self.learn_patterns(learned)
+        self.record("processed", ids=approved_ids)
         
         # Keep unapproved transactions in pending
-        remaining = [txn for txn in transactions if txn["id"] not in approved_ids]
-        if remaining:
-            self.state[f"pending_{thread_ts}"]["transactions"] = remaining
-        else:
-            self.state.pop(f"pending_{thread_ts}", None)
-        
-        self.save_state()
+        self.record("resolve", ts=thread_ts, ids=approved_ids)
+        self.flush()
+        remaining = self.count_pending_transactions(thread_ts)
         
         message = f"*Approved {len(approved_ids)} transaction(s):*\n\n" + "\n".join(results)
         if remaining:
-            message += f"\n\n_{len(remaining)} transaction(s) still pending approval._"
+            message += f"\n\n_{remaining} transaction(s) still pending approval._"
         
         return message
     
-    def change_category(self, transactions: List[Dict], txn_num: int, new_category: str, thread_ts: str, channel: str) -> str:
-        """Change category for a specific transaction"""
-        if txn_num < 1 or txn_num > len(transactions):
-            return f"❌ Invalid transaction number: {txn_num}"
-        
-        txn = transactions[txn_num - 1]
+    def change_category(self, transactions: List[Tuple[int, Dict]], txn_num: int, new_category: str, thread_ts: str, channel: str) -> str:
+        """Change category for a specific transaction number, as posted in the Slack message"""
+        txn = dict(transactions).get(txn_num)
+        if not txn:
+            return f"❌ Invalid or already approved transaction number: {txn_num}"
         
-        # Find matching category (case-insensitive)
-        matched_category = None
-        for cat_name in self.category_name_to_id.keys():
-            if cat_name.lower() == new_category.lower():
-                matched_category = cat_name
-                break
-        
-        if not matched_category:
-            # Try partial match
-            for cat_name in self.category_name_to_id.keys():
-                if new_category.lower() in cat_name.lower():
-                    matched_category = cat_name
-                    break
+        return self.change_transaction_category(txn, new_category, thread_ts)
+    
+    def change_transaction_category(self, txn: Dict, new_category: str, thread_ts: str) -> str:
+        """Set a pending transaction's category to the best match for `new_category` and approve it"""
+        # Find matching category (case-insensitive, then fuzzy)
+        matched_category = self.find_category(new_category)
+        if not matched_category and self.refresh_categories():
+            # It may be a category added since the cache was filled
+            matched_category = self.find_category(new_category)
         
         if not matched_category:
             available = ", ".join(sorted(self.category_name_to_id.keys())[:10])
@@ -212,66 +499,66 @@ class ApprovalHandler:
         
         if success:
             self.learn_pattern(txn["payee_name"], matched_category)
-            self.state["processed_transactions"].append(txn["id"])
+            self.record("processed", ids=[txn["id"]])
             
             # Remove from pending
-            remaining = [t for t in transactions if t["id"] != txn["id"]]
-            if remaining:
-                self.state[f"pending_{thread_ts}"]["transactions"] = remaining
-            else:
-                self.state.pop(f"pending_{thread_ts}", None)
-            
-            self.save_state()
+            self.record("resolve", ts=thread_ts, ids=[txn["id"]])
+            self.flush()
+            remaining = self.count_pending_transactions(thread_ts)
             
             message = f"✅ Updated: {txn['payee_name']} → {matched_category}"
             if remaining:
-                message += f"\n\n_{len(remaining)} transaction(s) still pending._"
+                message += f"\n\n_{remaining} transaction(s) still pending._"
             return message
         else:
             return f"❌ Failed to update {txn['payee_name']}"
     
+    @synchronized
     def approve_all_from_button(self, thread_ts: str, channel: str) -> str:
         """Handle approve all button click"""
-        return self.approve_all(self.find_pending_transactions(thread_ts), thread_ts, channel)
+        transactions = self.find_pending_transactions(thread_ts)
+        if not transactions:
+            return "❌ Could not find pending transactions."
+        return self.approve_all(transactions, thread_ts, channel)
     
-    def approve_specific_from_button(self, thread_ts: str, numbers: List[str], channel: str) -> str:
+    @synchronized
+    def approve_transaction_from_button(self, thread_ts: str, txn_id: str, channel: str) -> str:
         """Handle individual approve button click"""
-        return self.approve_specific(self.find_pending_transactions(thread_ts), numbers, thread_ts, channel)
+        found = self.find_pending_transaction(thread_ts, txn_id)
+        if not found:
+            return "❌ That transaction was already handled or is no longer pending."
+        return self.approve_selected([found], [], thread_ts)
     
-    def change_category_from_button(self, thread_ts: str, txn_num: int, new_category: str, channel: str) -> str:
+    @synchronized
+    def change_category_from_button(self, thread_ts: str, txn_id: str, new_category: str, channel: str) -> str:
         """Handle category dropdown selection"""
-        return self.change_category(self.find_pending_transactions(thread_ts), txn_num, new_category, thread_ts, channel)
+        found = self.find_pending_transaction(thread_ts, txn_id)
+        if not found:
+            return "❌ That transaction was already handled or is no longer pending."
+        return self.change_transaction_category(found[1], new_category, thread_ts)
     
+    @synchronized
     def approve_all_transfers_from_button(self, thread_ts: str, channel: str) -> str:
         """Handle approve all transfers button click"""
-        pending_key = f"pending_{thread_ts}"
-        if pending_key not in self.state:
+        pending = self.state["pending"].get(thread_ts)
+        if not pending:
             return "❌ Could not find pending transactions."
         
-        transfer_pairs = self.state[pending_key].get("transfer_pairs", [])
+        transfer_pairs = [] if pending.get("transfers_done") else read_pending_batch(pending["file"]).get("transfer_pairs", [])
         if not transfer_pairs:
             return "❌ No transfer pairs found."
         
+        # Approve both sides of every pair in one request
+        updated_ids = self.update_ynab_transactions_bulk([
+            {"id": txn["id"], "approved": True}
+            for pair in transfer_pairs for txn in pair
+        ])
+        
         results = []
         approved_ids = []
         
         for txn1, txn2 in transfer_pairs:
-            # Approve both transactions in the pair
-            url1 = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/transactions/{txn1['id']}"
-            url2 = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/transactions/{txn2['id']}"
-            
-            response1 = requests.patch(
-                url1,
-                headers=self.ynab_headers,
-                json={"transaction": {"approved": True}}
-            )
-            response2 = requests.patch(
-                url2,
-                headers=self.ynab_headers,
-                json={"transaction": {"approved": True}}
-            )
-            
-            if response1.status_code == 200 and response2.status_code == 200:
+            if txn1["id"] in updated_ids and txn2["id"] in updated_ids:
                 amount = abs(txn1["amount"]) / 1000
                 results.append(f"✅ ${amount:.2f} transfer approved")
                 approved_ids.extend([txn1["id"], txn2["id"]])
@@ -280,19 +567,175 @@ class ApprovalHandler:
                 results.append(f"❌ ${amount:.2f} transfer failed")
         
         # Mark as processed
-        self.state["processed_transactions"].extend(approved_ids)
+        self.record("processed", ids=approved_ids)
         
         # Clear transfer pairs from pending
-        self.state[pending_key]["transfer_pairs"] = []
-        self.save_state()
+        self.record("transfers_done", ts=thread_ts)
+        self.flush()
         
-        success_count = sum(1 for r in results if r.startswith("✅"))
-        
-        message = f"*Approved {success_count}/{len(transfer_pairs)} transfer pair(s):*\n\n" + "\n".join(results)
+        # Both sides of a pair are approved together
+        message = f"*Approved {len(approved_ids) // 2}/{len(transfer_pairs)} transfer pair(s):*\n\n" + "\n".join(results)
         return message
 
 
-handler = ApprovalHandler()
+# Built on first use so worker boot doesn't wait on the YNAB categories request
+_handler = None
+_handler_lock = threading.Lock()
+
+
+def get_handler() -> ApprovalHandler:
+    """Return this process's ApprovalHandler, creating it on first use"""
+    global _handler
+    if _handler is None:
+        with _handler_lock:
+            if _handler is None:
+                _handler = ApprovalHandler()
+    return _handler
+
+
+def is_duplicate_event(event_id: Optional[str]) -> bool:
+    """Remember recent Slack event ids and report whether this one was already seen"""
+    if not event_id:
+        return False
+    with seen_events_lock:
+        if event_id in seen_events:
+            seen_events.move_to_end(event_id)
+            return True
+        seen_events[event_id] = True
+        if len(seen_events) > SEEN_EVENTS_MAX:
+            seen_events.popitem(last=False)
+        return False
+
+
+def report_failure(future: Future, channel: str, thread_ts: str):
+    """Log errors from background work, which would otherwise be swallowed, and tell the thread"""
+    error = future.exception()
+    if error:
+        print(f"❌ Error handling Slack event: {error}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        post_to_slack("chat.postMessage", {
+            "channel": channel,
+            "thread_ts": thread_ts,
+            "text": "❌ Something went wrong handling that. Please try again."
+        })
+
+
+def run_in_background(channel: str, thread_ts: str, fn, *args):
+    """Run Slack event handling on the worker pool so the HTTP request can be ACKed right away"""
+    future = executor.submit(fn, *args)
+    future.add_done_callback(lambda f: report_failure(f, channel, thread_ts))
+
+
+def process_and_reply(text: str, thread_ts: str, channel: str):
+    """Process a text command and reply in the thread"""
+    response = get_handler().process_approval(text, thread_ts, channel)
+    
+    # Send response to Slack
+    post_to_slack("chat.postMessage", {
+        "channel": channel,
+        "thread_ts": thread_ts,
+        "text": response
+    })
+
+
+def handle_block_actions(payload: Dict):
+    """Process button clicks and dropdown selections from the interactive message"""
+    actions = payload["actions"]
+    message_ts = payload["message"]["ts"]
+    # Long batches continue in the first message's thread; pending state is keyed by that first message
+    batch_ts = payload["message"].get("thread_ts", message_ts)
+    channel = payload["channel"]["id"]
+    
+    for action in actions:
+        action_id = action["action_id"]
+        
+        # Handle "Approve All" button
+        if action_id == "approve_all_transactions":
+            response = get_handler().approve_all_from_button(batch_ts, channel)
+            
+            # Update the message
+            post_to_slack("chat.update", {
+                "channel": channel,
+                "ts": message_ts,
+                "text": response,
+                "blocks": [
+                    {
+                        "type": "section",
+                        "text": {"type": "mrkdwn", "text": response}
+                    }
+                ]
+            })
+        
+        # Handle "Approve All Transfers" button
+        elif action_id == "approve_all_transfers":
+            response = get_handler().approve_all_transfers_from_button(batch_ts, channel)
+            
+            # Send as thread reply
+            post_to_slack("chat.postMessage", {
+                "channel": channel,
+                "thread_ts": batch_ts,
+                "text": response
+            })
+            
+        # Handle individual "Approve" button
+        elif action_id.startswith("approve_transaction_"):
+            txn_id = action_id[len("approve_transaction_"):]
+            response = get_handler().approve_transaction_from_button(batch_ts, txn_id, channel)
+            
+            # Send as thread reply
+            post_to_slack("chat.postMessage", {
+                "channel": channel,
+                "thread_ts": batch_ts,
+                "text": response
+            })
+            
+        # Handle category dropdown change
+        elif action_id.startswith("change_category_"):
+            txn_id = action_id[len("change_category_"):]
+            new_category = action["selected_option"]["value"]
+            response = get_handler().change_category_from_button(batch_ts, txn_id, new_category, channel)
+            
+            # Send as thread reply
+            post_to_slack("chat.postMessage", {
+                "channel": channel,
+                "thread_ts": batch_ts,
+                "text": response
+            })
+        
+        # Handle "Skip" button
+        elif action_id == "skip_transactions":
+            post_to_slack("chat.update", {
+                "channel": channel,
+                "ts": message_ts,
+                "text": "👍 Skipped. I'll check again tomorrow.",
+                "blocks": [
+                    {
+                        "type": "section",
+                        "text": {"type": "mrkdwn", "text": "👍 Skipped. I'll check again tomorrow."}
+                    }
+                ]
+            })
+
+
+@app.before_request
+def verify_slack_signature():
+    """Reject requests that aren't signed by Slack or are too old to be fresh"""
+    if SLACK_SIGNER is None:
+        return None
+    
+    timestamp = request.headers.get("X-Slack-Request-Timestamp", "")
+    signature = request.headers.get("X-Slack-Signature", "")
+    try:
+        if abs(time.time() - int(timestamp)) > SLACK_SIGNATURE_MAX_AGE:
+            return jsonify({"error": "stale request"}), 400
+    except ValueError:
+        return jsonify({"error": "missing timestamp"}), 400
+    
+    signer = SLACK_SIGNER.copy()
+    signer.update(b"v0:" + timestamp.encode() + b":" + request.get_data())
+    if not hmac.compare_digest("v0=" + signer.hexdigest(), signature):
+        return jsonify({"error": "invalid signature"}), 401
+    return None
 
 
 @app.route("/slack/events", methods=["POST"])
@@ -304,10 +747,9 @@ def slack_events():
         data = request.json
     else:
         # Interactive components come as form-encoded payload
-        import json as json_module
         payload_str = request.form.get('payload')
         if payload_str:
-            data = json_module.loads(payload_str)
+            data = orjson.loads(payload_str)
         else:
             data = request.json
     
@@ -317,117 +759,8 @@ def slack_events():
     
     # Handle interactive button/dropdown clicks
     if data.get("type") == "block_actions":
-        payload = data
-        user_id = payload["user"]["id"]
-        actions = payload["actions"]
-        message_ts = payload["message"]["ts"]
-        channel = payload["channel"]["id"]
-        
-        for action in actions:
-            action_id = action["action_id"]
-            
-            # Handle "Approve All" button
-            if action_id == "approve_all_transactions":
-                response = handler.approve_all_from_button(message_ts, channel)
-                
-                # Update the message
-                requests.post(
-                    "https://slack.com/api/chat.update",
-                    headers={
-                        "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "channel": channel,
-                        "ts": message_ts,
-                        "text": response,
-                        "blocks": [
-                            {
-                                "type": "section",
-                                "text": {"type": "mrkdwn", "text": response}
-                            }
-                        ]
-                    }
-                )
-            
-            # Handle "Approve All Transfers" button
-            elif action_id == "approve_all_transfers":
-                response = handler.approve_all_transfers_from_button(message_ts, channel)
-                
-                # Send as thread reply
-                requests.post(
-                    "https://slack.com/api/chat.postMessage",
-                    headers={
-                        "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "channel": channel,
-                        "thread_ts": message_ts,
-                        "text": response
-                    }
-                )
-                
-            # Handle individual "Approve" button
-            elif action_id.startswith("approve_transaction_"):
-                txn_num = int(action_id.split("_")[-1])
-                response = handler.approve_specific_from_button(message_ts, [str(txn_num)], channel)
-                
-                # Send as thread reply
-                requests.post(
-                    "https://slack.com/api/chat.postMessage",
-                    headers={
-                        "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "channel": channel,
-                        "thread_ts": message_ts,
-                        "text": response
-                    }
-                )
-                
-            # Handle category dropdown change
-            elif action_id.startswith("change_category_"):
-                txn_num = int(action_id.split("_")[-1])
-                new_category = action["selected_option"]["value"]
-                response = handler.change_category_from_button(message_ts, txn_num, new_category, channel)
-                
-                # Send as thread reply
-                requests.post(
-                    "https://slack.com/api/chat.postMessage",
-                    headers={
-                        "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "channel": channel,
-                        "thread_ts": message_ts,
-                        "text": response
-                    }
-                )
-            
-            # Handle "Skip" button
-            elif action_id == "skip_transactions":
-                requests.post(
-                    "https://slack.com/api/chat.update",
-                    headers={
-                        "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "channel": channel,
-                        "ts": message_ts,
-                        "text": "👍 Skipped. I'll check again tomorrow.",
-                        "blocks": [
-                            {
-                                "type": "section",
-                                "text": {"type": "mrkdwn", "text": "👍 Skipped. I'll check again tomorrow."}
-                            }
-                        ]
-                    }
-                )
-        
+        message = data["message"]
+        run_in_background(data["channel"]["id"], message.get("thread_ts", message["ts"]), handle_block_actions, data)
         return jsonify({"ok": True})
     
     # Handle app mentions and messages (text-based commands)
@@ -444,26 +777,16 @@ def slack_events():
             channel = event.get("channel")
             thread_ts = event.get("thread_ts") or event.get("ts")
             
-            # Process the approval
-            response = handler.process_approval(text, thread_ts, channel)
+            # Slack re-delivers events it thinks timed out; only handle each once
+            if is_duplicate_event(data.get("event_id")):
+                return jsonify({"ok": True})
             
-            # Send response to Slack
-            requests.post(
-                "https://slack.com/api/chat.postMessage",
-                headers={
-                    "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "channel": channel,
-                    "thread_ts": thread_ts,
-                    "text": response
-                }
-            )
+            run_in_background(channel, thread_ts, process_and_reply, text, thread_ts, channel)
     
     return jsonify({"ok": True})
 
 
 if __name__ == "__main__":
+    # Local development only; deployments run under gunicorn's gevent worker (see Procfile)
     port = int(os.getenv("PORT", 8080))
     app.run(host="0.0.0.0", port=port)
@@ -5,11 +5,23 @@ Fetches uncategorized transactions, uses AI to suggest categories, and sends bat
 """
 
 import os
-import json
+import re
+import hashlib
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import List, Dict, Optional
 import sys
+import time
+from ynab_state import (
+    STATE_FILE, apply_journal_entry, index_pending_transactions, merge_category_groups,
+    prune_pending, read_journal, write_pending_batch
+)
 
 # Configuration from environment variables
 YNAB_API_TOKEN = os.getenv("YNAB_API_TOKEN")
@@ -18,126 +30,254 @@ SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 SLACK_CHANNEL = os.getenv("SLACK_CHANNEL", "#ynab-transactions")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "deepseek/deepseek-chat")
+# Ask OpenRouter to route to the lowest-latency provider of the model rather than its default (price-weighted) choice
+OPENROUTER_LATENCY_MODE = os.getenv("OPENROUTER_LATENCY_MODE", "").lower() in ("1", "true", "yes")
 
-# File to store processed transaction IDs and learning data
-STATE_FILE = "/tmp/ynab_agent_state.json"
+# Characters ignored when matching payees against learned patterns
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+# System prompt for categorize_with_ai; the user message is a compact JSON payload
+CATEGORIZE_INSTRUCTIONS = (
+    "Categorize YNAB (You Need A Budget) transactions. Input JSON: categories (allowed names), "
+    "patterns (payee -> category the user approved before), txns (n, payee, amt in dollars, date, "
+    "optional hint = YNAB's own guess). Prefer a matching pattern, then the hint, then the payee, "
+    "amount and date. Only use allowed categories. Reply with a JSON object whose suggestions array has "
+    "one object per txn in order: {\"suggestions\": [{\"n\": 1, \"category\": \"Name\", \"confidence\": \"high|medium|low\"}]}"
+)
+# Markdown code fence (optionally tagged json, any case), for models that ignore JSON mode
+FENCE_RE = re.compile(r'```(?:json)?\s*(.+?)\s*```', re.DOTALL | re.IGNORECASE)
+# Marker shown next to each suggestion; anything unrecognised is treated as low
+CONFIDENCE_EMOJI = {"high": "🟢", "medium": "🟡", "low": "🔴"}
+# Transactions sent to the model per request; larger runs are split and the chunks sent concurrently
+BATCH_ROWS = 25
+# Slack's limit on blocks in a single message
+SLACK_MAX_BLOCKS = 50
+# How long (seconds) YNAB categories and account names cached in the state are reused
+YNAB_CACHE_TTL = 86400
+
+
+def make_session(headers: Dict[str, str]) -> requests.Session:
+    """Create a keep-alive session with pooled connections, retries on transient errors, and default headers"""
+    session = requests.Session()
+    session.headers.update(headers)
+    # POST is retried too: a 429/5xx from OpenRouter or Slack shouldn't cost the whole run.
+    # Waits double from 0.3s, or follow the server's Retry-After when it sends one
+    retries = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+        respect_retry_after_header=True
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries))
+    return session
+
+
+# Category keyword -> emoji; the first keyword found in a category name wins
+EMOJI_MAP = {
+    "groceries": "🛒", "grocery": "🛒",
+    "dining": "🍽️", "restaurant": "🍽️", "food": "🍽️",
+    "gas": "⛽", "fuel": "⛽",
+    "coffee": "☕",
+    "shopping": "🛍️",
+    "entertainment": "🎬",
+    "utilities": "💡",
+    "rent": "🏠", "housing": "🏠", "mortgage": "🏠",
+    "transportation": "🚗", "transit": "🚇",
+    "health": "🏥", "medical": "🏥",
+    "fitness": "💪", "gym": "💪",
+    "subscriptions": "📱",
+    "insurance": "🛡️",
+    "gifts": "🎁",
+    "travel": "✈️",
+    "clothing": "👕",
+    "personal": "👤",
+    "pets": "🐾",
+    "education": "📚",
+    "income": "💰",
+    "savings": "🏦",
+}
+
+
+# Rank of each keyword in EMOJI_MAP, and one pattern finding every keyword occurrence (the lookahead lets matches overlap)
+EMOJI_RANK = {key: rank for rank, key in enumerate(EMOJI_MAP)}
+EMOJI_RE = re.compile("(?=(" + "|".join(map(re.escape, sorted(EMOJI_MAP, key=len, reverse=True))) + "))")
+
+
+@lru_cache(maxsize=None)
+def category_emoji(category: str) -> str:
+    """Emoji for a category name (memoised, since the same few categories repeat every run)"""
+    category_lower = category.lower()
+    if category_lower in EMOJI_MAP:
+        return EMOJI_MAP[category_lower]
+    found = [match.group(1) for match in EMOJI_RE.finditer(category_lower)]
+    if not found:
+        return "💳"
+    return EMOJI_MAP[min(found, key=EMOJI_RANK.__getitem__)]
+
+
+def pack_blocks(head: List[Dict], rows: List[List[Dict]], tail: List[Dict]) -> List[List[Dict]]:
+    """Split head + rows + tail into messages of at most SLACK_MAX_BLOCKS blocks, never splitting a row"""
+    messages = [list(head)]
+    for row in rows:
+        if len(messages[-1]) + len(row) > SLACK_MAX_BLOCKS:
+            messages.append([])
+        messages[-1].extend(row)
+    if len(messages[-1]) + len(tail) > SLACK_MAX_BLOCKS:
+        messages.append([])
+    messages[-1].extend(tail)
+    return messages
+
+
+def normalize_payee(payee_name: Optional[str]) -> str:
+    """Lowercase a payee name and drop punctuation and extra whitespace, for pattern lookups"""
+    return " ".join(PUNCTUATION_RE.sub("", payee_name or "").lower().split())
 
 
 class YNABAgent:
     def __init__(self):
-        self.ynab_headers = {
+        # YNAB credentials are the session default; OpenRouter and Slack calls pass their own headers
+        self.session = make_session({
             "Authorization": f"Bearer {YNAB_API_TOKEN}",
             "Content-Type": "application/json"
-        }
+        })
+        # Overlaps independent requests within a run (YNAB fetches, AI chunks); shut down with the session when run() ends
+        self.executor = ThreadPoolExecutor(max_workers=4)
         self.state = self.load_state()
+        # save_state() only writes when something changed since loading
+        self.state_dirty = False
+        self.state_hash = hashlib.blake2b(self.serialize_state()).digest()
+        # Set view of processed_transactions for membership tests; the list keeps recency order
+        self.processed_ids = set(self.state["processed_transactions"])
+        # Learned patterns keyed by normalized payee, for exact-match lookups
+        self.pattern_index = {
+            normalize_payee(payee): category
+            for payee, category in self.state["category_patterns"].items()
+        }
+        # Derived from the categories dict last passed in; see category_views()
+        self.categories_seen = None
+        self.sorted_category_names = []
+        self.category_select = {}
     
     def load_state(self) -> Dict:
         """Load agent state (processed transactions, learned patterns)"""
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                return json.load(f)
-        return {
+        state = {
             "processed_transactions": [],
-            "category_patterns": {}  # merchant -> category mappings learned from approvals
+            "category_patterns": {},  # merchant -> category mappings learned from approvals
+            "pending": {}  # Slack message ts -> batch awaiting approval
         }
+        if os.path.exists(STATE_FILE):
+            with open(STATE_FILE, 'rb') as f:
+                state = orjson.loads(f.read())
+        index_pending_transactions(state)
+        
+        # Pick up approvals the handler has journaled since its last snapshot
+        for entry in read_journal():
+            apply_journal_entry(state, entry)
+        return state
+    
+    def serialize_state(self) -> bytes:
+        """Encode the state as it is written to STATE_FILE"""
+        return orjson.dumps(self.state)
     
     def save_state(self):
-        """Save agent state"""
-        with open(STATE_FILE, 'w') as f:
-            json.dump(self.state, f, indent=2)
+        """Save agent state, skipping the write when nothing changed"""
+        if prune_pending(self.state):
+            self.state_dirty = True
+        if not self.state_dirty:
+            return
+        
+        data = self.serialize_state()
+        digest = hashlib.blake2b(data).digest()
+        if digest != self.state_hash:
+            # Write a temp file and rename it so a crash never leaves a half-written state file
+            tmp_path = STATE_FILE + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, STATE_FILE)
+            self.state_hash = digest
+        self.state_dirty = False
+    
+    def get_cached(self, key: str, fetch) -> Dict:
+        """
+        Return state["ynab_cache"][key] while it is fresh. Otherwise call fetch(cached), which
+        returns (data, server_knowledge) and may only ask YNAB for changes since the cached copy.
+        """
+        cached = self.state.setdefault("ynab_cache", {}).get(key)
+        if cached and time.time() - cached["fetched_at"] < YNAB_CACHE_TTL:
+            return cached["data"]
+        
+        data, server_knowledge = fetch(cached)
+        self.state["ynab_cache"][key] = {"data": data, "fetched_at": time.time(), "server_knowledge": server_knowledge}
+        self.state_dirty = True
+        return data
     
     def get_budget_categories(self) -> Dict[str, str]:
-        """Fetch all budget categories from YNAB"""
+        """Budget categories (id -> name), cached in the state"""
+        return self.get_cached("categories", self.fetch_budget_categories)
+    
+    def fetch_budget_categories(self, cached: Optional[Dict] = None) -> tuple[Dict[str, str], int]:
+        """Fetch budget categories from YNAB, only the changes if a cached copy has a server_knowledge"""
         url = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/categories"
-        response = requests.get(url, headers=self.ynab_headers)
-        response.raise_for_status()
+        categories, params = {}, {}
+        if cached and "server_knowledge" in cached:
+            categories = dict(cached["data"])
+            params["last_knowledge_of_server"] = cached["server_knowledge"]
         
-        categories = {}
-        for group in response.json()["data"]["category_groups"]:
-            if group["name"] in ["Internal Master Category", "Hidden Categories"]:
-                continue
-            for cat in group["categories"]:
-                if not cat["hidden"] and not cat["deleted"]:
-                    categories[cat["id"]] = cat["name"]
+        response = self.session.get(url, params=params)
+        response.raise_for_status()
+        data = orjson.loads(response.content)["data"]
         
-        return categories
+        return merge_category_groups(categories, data["category_groups"]), data["server_knowledge"]
     
     def get_uncategorized_transactions(self, days_back: int = 7) -> List[Dict]:
         """Fetch unapproved transactions from YNAB"""
         since_date = (datetime.now() - timedelta(days=days_back)).strftime("%Y-%m-%d")
         url = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/transactions"
-        params = {"since_date": since_date}
+        # type=unapproved has YNAB drop approved transactions server-side, so the response only holds candidates
+        params = {"since_date": since_date, "type": "unapproved"}
         
-        response = requests.get(url, headers=self.ynab_headers, params=params)
+        response = self.session.get(url, params=params)
         response.raise_for_status()
         
-        all_transactions = response.json()["data"]["transactions"]
-        
-        # Filter for unapproved transactions (includes both uncategorized AND auto-categorized but not approved)
-        unapproved = []
-        for txn in all_transactions:
-            # Skip if already approved or already processed
-            if txn["approved"] or txn["id"] in self.state["processed_transactions"]:
-                continue
-            # Skip split transactions (parent) but NOT transfers
-            if txn.get("subtransactions"):
-                continue
-            # Skip if deleted
-            if txn["deleted"]:
-                continue
-            
-            unapproved.append(txn)
+        all_transactions = orjson.loads(response.content)["data"]["transactions"]
+        
+        # Unapproved transactions (both uncategorized AND auto-categorized but not approved),
+        # skipping already processed, deleted, and split (parent) transactions - but NOT transfers
+        processed_ids = self.processed_ids
+        unapproved = [
+            txn for txn in all_transactions
+            if not txn["approved"]
+            and not txn["deleted"]
+            and not txn.get("subtransactions")
+            and txn["id"] not in processed_ids
+        ]
+        
+        # Dollar amount for display, computed once (YNAB uses milliunits)
+        for txn in unapproved:
+            txn["_amount_usd"] = abs(txn["amount"]) / 1000
         
         return unapproved
     
-    def detect_transfer_pairs(self, transactions):
-        """
-        Detect matching transfer pairs and separate them from regular transactions.
-        Returns: (transfer_pairs, non_transfer_transactions)
-        """
-        transfers = [txn for txn in transactions if txn.get("transfer_account_id")]
-        non_transfers = [txn for txn in transactions if not txn.get("transfer_account_id")]
-        
-        # Group transfers by amount and date to find pairs
-        transfer_pairs = []
-        processed_ids = set()
-        
-        for i, txn1 in enumerate(transfers):
-            if txn1["id"] in processed_ids:
-                continue
-                
-            amount1 = txn1["amount"]
-            date1 = txn1["date"]
-            account1 = txn1["account_id"]
-            transfer_account1 = txn1.get("transfer_account_id")
-            
-            # Look for matching transfer (opposite amount, same date, accounts match)
-            for txn2 in transfers[i+1:]:
-                if txn2["id"] in processed_ids:
-                    continue
-                
-                amount2 = txn2["amount"]
-                date2 = txn2["date"]
-                account2 = txn2["account_id"]
-                transfer_account2 = txn2.get("transfer_account_id")
-                
-                # Check if they're a matching pair
-                if (date1 == date2 and 
-                    amount1 == -amount2 and
-                    account1 == transfer_account2 and
-                    account2 == transfer_account1):
-                    
-                    transfer_pairs.append((txn1, txn2))
-                    processed_ids.add(txn1["id"])
-                    processed_ids.add(txn2["id"])
-                    break
-        
-        # Any unmatched transfers go back into non_transfers
-        unmatched_transfers = [txn for txn in transfers if txn["id"] not in processed_ids]
-        non_transfers.extend(unmatched_transfers)
+    def get_account_names(self) -> Dict[str, str]:
+        """Account names (id -> name), cached in the state"""
+        return self.get_cached("accounts", self.fetch_account_names)
+    
+    def fetch_account_names(self, cached: Optional[Dict] = None) -> tuple[Dict[str, str], int]:
+        """Fetch account names from YNAB, only the changes if a cached copy has a server_knowledge"""
+        url = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/accounts"
+        accounts, params = {}, {}
+        if cached and "server_knowledge" in cached:
+            accounts = dict(cached["data"])
+            params["last_knowledge_of_server"] = cached["server_knowledge"]
+        
+        response = self.session.get(url, params=params)
+        response.raise_for_status()
+        data = orjson.loads(response.content)["data"]
         
-        return transfer_pairs, non_transfers
-
+        accounts.update((acc["id"], acc["name"]) for acc in data["accounts"])
+        return accounts, data["server_knowledge"]
     
     def detect_transfer_pairs(self, transactions: List[Dict]) -> tuple[List[tuple], List[Dict]]:
         """
@@ -147,101 +287,107 @@ class YNABAgent:
         transfers = [txn for txn in transactions if txn.get("transfer_account_id")]
         non_transfers = [txn for txn in transactions if not txn.get("transfer_account_id")]
         
-        # Group transfers by amount and date to find pairs
+        # Index unmatched transfers by (date, account, other account, amount); a transfer's
+        # partner is the other side: same date, accounts swapped, opposite amount
         transfer_pairs = []
-        processed_ids = set()
-        
-        for i, txn1 in enumerate(transfers):
-            if txn1["id"] in processed_ids:
-                continue
-                
-            amount1 = txn1["amount"]
-            date1 = txn1["date"]
-            account1 = txn1["account_id"]
-            transfer_account1 = txn1.get("transfer_account_id")
-            
-            # Look for matching transfer (opposite amount, same date, accounts match)
-            for txn2 in transfers[i+1:]:
-                if txn2["id"] in processed_ids:
-                    continue
-                
-                amount2 = txn2["amount"]
-                date2 = txn2["date"]
-                account2 = txn2["account_id"]
-                transfer_account2 = txn2.get("transfer_account_id")
-                
-                # Check if they're a matching pair
-                if (date1 == date2 and 
-                    amount1 == -amount2 and
-                    account1 == transfer_account2 and
-                    account2 == transfer_account1):
-                    
-                    transfer_pairs.append((txn1, txn2))
-                    processed_ids.add(txn1["id"])
-                    processed_ids.add(txn2["id"])
-                    break
+        waiting = defaultdict(list)
+        
+        for txn in transfers:
+            partner_key = (txn["date"], txn["transfer_account_id"], txn["account_id"], -txn["amount"])
+            candidates = waiting.get(partner_key)
+            if candidates:
+                transfer_pairs.append((candidates.pop(0), txn))
+            else:
+                waiting[(txn["date"], txn["account_id"], txn["transfer_account_id"], txn["amount"])].append(txn)
         
         # Any unmatched transfers go back into non_transfers
-        unmatched_transfers = [txn for txn in transfers if txn["id"] not in processed_ids]
-        non_transfers.extend(unmatched_transfers)
+        matched_ids = {txn["id"] for pair in transfer_pairs for txn in pair}
+        non_transfers.extend(txn for txn in transfers if txn["id"] not in matched_ids)
         
         return transfer_pairs, non_transfers
     
+    def lookup_pattern(self, payee_name: Optional[str]) -> Optional[str]:
+        """
+        Category learned for a payee: an exact match on the normalized name, else the longest
+        learned payee made of its leading words ("amazon" covers "Amazon Mktp US 2K4")
+        """
+        words = normalize_payee(payee_name).split()
+        for end in range(len(words), 0, -1):
+            category = self.pattern_index.get(" ".join(words[:end]))
+            if category:
+                return category
+        return None
+    
     def categorize_with_ai(self, transactions: List[Dict], categories: Dict[str, str]) -> List[Dict]:
         """Use Claude via OpenRouter to suggest categories for transactions"""
         if not transactions:
             return []
         
-        # Build context with learned patterns
-        learned_patterns = "\n".join([
-            f"- {merchant}: {category}"
-            for merchant, category in self.state["category_patterns"].items()
-        ]) if self.state["category_patterns"] else "No learned patterns yet."
+        # Payees the user has already approved a category for don't need the model
+        category_names = set(categories.values())
+        unknown = []
+        for txn in transactions:
+            learned = self.lookup_pattern(txn["payee_name"])
+            if learned in category_names:
+                txn["suggested_category"] = learned
+                txn["confidence"] = "high"
+            else:
+                unknown.append(txn)
         
-        # Prepare transaction list for AI
-        txn_list = []
-        for i, txn in enumerate(transactions, 1):
-            amount = abs(txn["amount"]) / 1000  # YNAB uses milliunits
-            existing_cat = None
+        if not unknown:
+            return transactions
+        
+        # Categories and learned patterns are the same in every chunk's prompt; encode them once
+        context = orjson.dumps({
+            "categories": self.category_views(categories),
+            "patterns": self.state["category_patterns"]
+        })
+        
+        # Each chunk is numbered from 1 and answered positionally, so results concatenate in order
+        chunks = [unknown[i:i + BATCH_ROWS] for i in range(0, len(unknown), BATCH_ROWS)]
+        results = self.executor.map(lambda chunk: self.request_suggestions(chunk, categories, context), chunks)
+        
+        # Match suggestions back to transactions
+        for chunk, suggestions in zip(chunks, results):
+            for i, txn in enumerate(chunk):
+                suggestion = suggestions[i]
+                txn["suggested_category"] = suggestion["category"]
+                txn["confidence"] = suggestion.get("confidence", "medium")
+        
+        return transactions
+    
+    def build_prompt(self, chunk: List[Dict], categories: Dict[str, str], context: bytes) -> str:
+        """Compact JSON payload: the encoded categories/patterns object `context`, plus one short record per transaction"""
+        txn_records = []
+        for i, txn in enumerate(chunk, 1):
+            record = {"n": i, "payee": txn["payee_name"], "amt": round(txn["_amount_usd"], 2), "date": txn["date"]}
             if txn.get("category_id"):
-                existing_cat = categories.get(txn["category_id"], "Unknown")
-            
-            txn_str = f"{i}. {txn['payee_name']} - ${amount:.2f} on {txn['date']}"
-            if existing_cat:
-                txn_str += f" (YNAB suggested: {existing_cat})"
-            txn_list.append(txn_str)
+                record["hint"] = categories.get(txn["category_id"], "Unknown")
+            txn_records.append(record)
         
-        category_list = "\n".join([f"- {name}" for name in sorted(set(categories.values()))])
-        txn_list_str = "\n".join(txn_list)
+        # Splice the records into the shared object in place of its closing brace
+        return (context[:-1] + b',"txns":' + orjson.dumps(txn_records) + b"}").decode()
+    
+    def request_suggestions(self, chunk: List[Dict], categories: Dict[str, str], context: bytes) -> List[Dict]:
+        """Ask the model for one suggestion per transaction in `chunk`, in order"""
+        prompt = self.build_prompt(chunk, categories, context)
+        
+        body = {
+            "model": OPENROUTER_MODEL,
+            "messages": [
+                {"role": "system", "content": CATEGORIZE_INSTRUCTIONS},
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": 0.3,
+            "response_format": {"type": "json_object"},
+            # Roughly 40 tokens per suggestion, plus the wrapping object
+            "max_tokens": min(2000, 50 + 40 * len(chunk))
+        }
+        if OPENROUTER_LATENCY_MODE:
+            body["provider"] = {"sort": "latency", "allow_fallbacks": True}
         
-        prompt = f"""You are helping categorize personal finance transactions for YNAB (You Need A Budget).
-
-Available categories:
-{category_list}
-
-Previously learned patterns from user approvals:
-{learned_patterns}
-
-Unapproved transactions (some may have YNAB's auto-suggestion):
-{txn_list_str}
-
-For each transaction, suggest the most appropriate category based on:
-1. Previously learned patterns (highest priority - the user has approved these before)
-2. YNAB's existing suggestion if shown (consider it but you can override if learned patterns say otherwise)
-3. The merchant/payee name
-4. Common transaction categorization logic
-5. The transaction amount and date if relevant
-
-Respond in JSON format with an array of objects, one per transaction:
-[
-  {{"transaction_number": 1, "category": "Category Name", "confidence": "high/medium/low"}},
-  ...
-]
-
-Be concise and accurate. Only use categories from the available list."""
-
         # Call OpenRouter API
-        response = requests.post(
+        response = self.session.post(
             "https://openrouter.ai/api/v1/chat/completions",
             headers={
                 "Authorization": f"Bearer {OPENROUTER_API_KEY}",
@@ -249,102 +395,75 @@ Be concise and accurate. Only use categories from the available list."""
                 "HTTP-Referer": "https://github.com/yourusername/ynab-agent",
                 "X-Title": "YNAB Categorization Agent"
             },
-            json={
-                "model": OPENROUTER_MODEL,
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ],
-                "temperature": 0.3,
-                "max_tokens": 2000
-            }
+            data=orjson.dumps(body)
         )
         response.raise_for_status()
         
         # Parse AI response
-        ai_response = response.json()["choices"][0]["message"]["content"]
-        
-        # Extract JSON from response (handle markdown code blocks)
-        if "```json" in ai_response:
-            ai_response = ai_response.split("```json")[1].split("```")[0].strip()
-        elif "```" in ai_response:
-            ai_response = ai_response.split("```")[1].split("```")[0].strip()
+        ai_response = orjson.loads(response.content)["choices"][0]["message"]["content"]
         
-        suggestions = json.loads(ai_response)
-        
-        # Match suggestions back to transactions
-        for i, txn in enumerate(transactions):
-            suggestion = suggestions[i]
-            txn["suggested_category"] = suggestion["category"]
-            txn["confidence"] = suggestion.get("confidence", "medium")
-        
-        return transactions
+        try:
+            reply = orjson.loads(ai_response)
+        except orjson.JSONDecodeError:
+            # Not every model honours response_format; fall back to a fenced block
+            fence = FENCE_RE.search(ai_response)
+            if not fence:
+                raise
+            reply = orjson.loads(fence.group(1))
+        
+        return reply["suggestions"]
     
-    def format_slack_message(self, transactions: List[Dict]) -> str:
-        """Format transactions as a Slack message"""
-        if not transactions:
-            return "✅ No uncategorized transactions found!"
-        
-        message = f"📋 *Good morning! You have {len(transactions)} uncategorized transaction(s):*\n\n"
-        
-        for i, txn in enumerate(transactions, 1):
-            amount = abs(txn["amount"]) / 1000
-            emoji = self.get_category_emoji(txn["suggested_category"])
-            confidence = txn.get("confidence", "medium")
-            confidence_emoji = "🟢" if confidence == "high" else "🟡" if confidence == "medium" else "🔴"
-            
-            message += f"{i}. {emoji} *{txn['payee_name']}* - ${amount:.2f}\n"
-            message += f"   → {txn['suggested_category']} {confidence_emoji}\n"
-            message += f"   _{txn['date']}_\n\n"
-        
-        message += "\n*To approve:*\n"
-        message += "• Reply `approve all` to categorize everything\n"
-        message += "• Reply `approve 1,3,5` to approve specific numbers\n"
-        message += "• Reply `1: Groceries` to change category for transaction 1\n"
-        message += "• Reply `skip` to ignore for now\n"
-        
-        return message
+    def add_display_fields(self, transactions: List[Dict]):
+        """Attach the category and confidence emoji to each categorized transaction, for the Slack formatters"""
+        for txn in transactions:
+            txn["_emoji"] = self.get_category_emoji(txn["suggested_category"])
+            txn["_confidence_emoji"] = CONFIDENCE_EMOJI.get(txn.get("confidence", "medium"), "🔴")
     
     def get_category_emoji(self, category: str) -> str:
         """Return emoji for category"""
-        emoji_map = {
-            "groceries": "🛒", "grocery": "🛒",
-            "dining": "🍽️", "restaurant": "🍽️", "food": "🍽️",
-            "gas": "⛽", "fuel": "⛽",
-            "coffee": "☕",
-            "shopping": "🛍️",
-            "entertainment": "🎬",
-            "utilities": "💡",
-            "rent": "🏠", "housing": "🏠", "mortgage": "🏠",
-            "transportation": "🚗", "transit": "🚇",
-            "health": "🏥", "medical": "🏥",
-            "fitness": "💪", "gym": "💪",
-            "subscriptions": "📱",
-            "insurance": "🛡️",
-            "gifts": "🎁",
-            "travel": "✈️",
-            "clothing": "👕",
-            "personal": "👤",
-            "pets": "🐾",
-            "education": "📚",
-            "income": "💰",
-            "savings": "🏦",
-        }
+        return category_emoji(category)
+    
+    def category_views(self, categories: Dict[str, str]) -> List[str]:
+        """Sorted category names and the dropdown built from them, recomputed only when `categories` changes"""
+        if categories is not self.categories_seen:
+            self.categories_seen = categories
+            self.sorted_category_names = sorted(set(categories.values()))
+            # Category dropdown shared by every transaction; only the action_id differs
+            self.category_select = {
+                "type": "static_select",
+                "placeholder": {
+                    "type": "plain_text",
+                    "text": "Change category",
+                    "emoji": True
+                },
+                "options": [
+                    {"text": {"type": "plain_text", "text": cat}, "value": cat}
+                    for cat in self.sorted_category_names
+                ]
+            }
+        return self.sorted_category_names
+    
+    def post_slack_message(self, payload: Dict) -> str:
+        """Post a chat.postMessage payload and return the new message's ts"""
+        response = self.session.post(
+            "https://slack.com/api/chat.postMessage",
+            headers={
+                "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
+                "Content-Type": "application/json"
+            },
+            data=orjson.dumps(payload)
+        )
+        response.raise_for_status()
+        result = orjson.loads(response.content)
         
-        category_lower = category.lower()
-        for key, emoji in emoji_map.items():
-            if key in category_lower:
-                return emoji
-        return "💳"
+        if not result["ok"]:
+            raise Exception(f"Slack API error: {result.get('error')}")
+        return result["ts"]
     
-    def send_to_slack(self, message: str, transactions: List[Dict], transfer_pairs=None) -> str:
-        """Send message to Slack with interactive buttons and dropdowns"""
-        
-        # Get all category names for the dropdown
-        categories = self.get_budget_categories()
-        category_options = [
-            {"text": {"type": "plain_text", "text": cat}, "value": cat}
-            for cat in sorted(set(categories.values()))
-        ]
+    def build_slack_blocks(self, transactions: List[Dict], categories: Dict[str, str], transfer_pairs=None, accounts: Optional[Dict[str, str]] = None) -> List[List[Dict]]:
+        """Build the interactive Block Kit messages for a batch: the first message, then any thread follow-ups"""
+        self.category_views(categories)
+        category_select = self.category_select
         
         if transfer_pairs is None:
             transfer_pairs = []
@@ -366,10 +485,8 @@ Be concise and accurate. Only use categories from the available list."""
         # Add transfer pairs section if any exist
         if transfer_pairs:
             # Get account names
-            accounts_url = f"https://api.ynab.com/v1/budgets/{YNAB_BUDGET_ID}/accounts"
-            accounts_response = requests.get(accounts_url, headers=self.ynab_headers)
-            accounts_response.raise_for_status()
-            accounts = {acc["id"]: acc["name"] for acc in accounts_response.json()["data"]["accounts"]}
+            if accounts is None:
+                accounts = self.get_account_names()
             
             blocks.append({"type": "divider"})
             blocks.append({
@@ -381,18 +498,15 @@ Be concise and accurate. Only use categories from the available list."""
             })
             
             # List each transfer pair
-            transfer_list = []
-            for txn1, txn2 in transfer_pairs:
-                amount = abs(txn1["amount"]) / 1000
-                account1 = accounts.get(txn1["account_id"], "Unknown")
-                account2 = accounts.get(txn2["account_id"], "Unknown")
-                transfer_list.append(f"• ${amount:.2f} - {account1} ↔ {account2}")
-            
             blocks.append({
                 "type": "section",
                 "text": {
                     "type": "mrkdwn",
-                    "text": "\n".join(transfer_list)
+                    "text": "\n".join(
+                        f"• ${txn1['_amount_usd']:.2f} - "
+                        f"{accounts.get(txn1['account_id'], 'Unknown')} ↔ {accounts.get(txn2['account_id'], 'Unknown')}"
+                        for txn1, txn2 in transfer_pairs
+                    )
                 }
             })
             
@@ -428,18 +542,18 @@ Be concise and accurate. Only use categories from the available list."""
         else:
             blocks.append({"type": "divider"})
         
-        # Add a section for each transaction with buttons
+        # Add a section for each transaction with buttons keyed by its YNAB id; each row's blocks stay in one message
+        rows = []
         for i, txn in enumerate(transactions, 1):
-            amount = abs(txn["amount"]) / 1000
-            emoji = self.get_category_emoji(txn["suggested_category"])
-            confidence = txn.get("confidence", "medium")
-            confidence_emoji = "🟢" if confidence == "high" else "🟡" if confidence == "medium" else "🔴"
-            
-            blocks.append({
+            row = []
+            row.append({
                 "type": "section",
                 "text": {
                     "type": "mrkdwn",
-                    "text": f"*{i}. {emoji} {txn['payee_name']}* - ${amount:.2f}\n→ {txn['suggested_category']} {confidence_emoji}\n_{txn['date']}_"
+                    "text": (
+                        f"*{i}. {txn['_emoji']} {txn['payee_name']}* - ${txn['_amount_usd']:.2f}\n"
+                        f"→ {txn['suggested_category']} {txn['_confidence_emoji']}\n_{txn['date']}_"
+                    )
                 },
                 "accessory": {
                     "type": "button",
@@ -448,35 +562,27 @@ Be concise and accurate. Only use categories from the available list."""
                         "text": "✓ Approve",
                         "emoji": True
                     },
-                    "value": f"approve_{i}",
-                    "action_id": f"approve_transaction_{i}",
+                    "value": txn["id"],
+                    "action_id": f"approve_transaction_{txn['id']}",
                     "style": "primary"
                 }
             })
             
             # Add category dropdown below
-            blocks.append({
+            row.append({
                 "type": "section",
                 "text": {
                     "type": "mrkdwn",
                     "text": " "
                 },
-                "accessory": {
-                    "type": "static_select",
-                    "placeholder": {
-                        "type": "plain_text",
-                        "text": "Change category",
-                        "emoji": True
-                    },
-                    "options": category_options,
-                    "action_id": f"change_category_{i}"
-                }
+                "accessory": {**category_select, "action_id": f"change_category_{txn['id']}"}
             })
             
-            blocks.append({"type": "divider"})
+            row.append({"type": "divider"})
+            rows.append(row)
         
         # Add bulk action buttons
-        blocks.append({
+        bulk_actions = {
             "type": "actions",
             "elements": [
                 {
@@ -501,35 +607,44 @@ Be concise and accurate. Only use categories from the available list."""
                     "action_id": "skip_transactions"
                 }
             ]
-        })
+        }
         
-        response = requests.post(
-            "https://slack.com/api/chat.postMessage",
-            headers={
-                "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
-                "Content-Type": "application/json"
-            },
-            json={
+        # Slack rejects messages over 50 blocks, so long batches continue in the first message's thread
+        return pack_blocks(blocks, rows, [bulk_actions])
+    
+    def send_to_slack(self, transactions: List[Dict], categories: Dict[str, str], transfer_pairs=None, accounts: Optional[Dict[str, str]] = None) -> str:
+        """Send the batch to Slack with interactive buttons and dropdowns, and remember it as pending"""
+        if transfer_pairs is None:
+            transfer_pairs = []
+        
+        messages = self.build_slack_blocks(transactions, categories, transfer_pairs, accounts)
+        ts = self.post_slack_message({
+            "channel": SLACK_CHANNEL,
+            "text": f"You have {len(transactions)} uncategorized transactions",  # Fallback text
+            "blocks": messages[0],
+            "unfurl_links": False,
+            "unfurl_media": False
+        })
+        message_ts = [ts]
+        for follow_up in messages[1:]:
+            # Posted one at a time so the thread keeps the transactions in order
+            message_ts.append(self.post_slack_message({
                 "channel": SLACK_CHANNEL,
-                "text": f"You have {len(transactions)} uncategorized transactions",  # Fallback text
-                "blocks": blocks,
+                "thread_ts": ts,
+                "text": "More uncategorized transactions",  # Fallback text
+                "blocks": follow_up,
                 "unfurl_links": False,
                 "unfurl_media": False
-            }
-        )
-        response.raise_for_status()
-        result = response.json()
+            }))
         
-        if not result["ok"]:
-            raise Exception(f"Slack API error: {result.get('error')}")
-        
-        # Store transaction data keyed by message timestamp
-        ts = result["ts"]
-        self.state[f"pending_{ts}"] = {
-            "transactions": transactions,
+        # Store transaction data keyed by the first message's timestamp
+        self.state["pending"][ts] = write_pending_batch(ts, {
+            "transactions": {txn["id"]: txn for txn in transactions},
             "transfer_pairs": transfer_pairs if transfer_pairs else [],
+            "message_ts": message_ts,
             "timestamp": datetime.now().isoformat()
-        }
+        })
+        self.state_dirty = True
         self.save_state()
         
         return ts
@@ -547,18 +662,18 @@ Be concise and accurate. Only use categories from the available list."""
             sys.exit(1)
         
         try:
-            # Fetch categories
-            print("📂 Fetching YNAB categories...")
-            categories = self.get_budget_categories()
+            # Fetch categories and unapproved transactions concurrently (they don't depend on each other)
+            print("📂 Fetching YNAB categories and unapproved transactions...")
+            categories_future = self.executor.submit(self.get_budget_categories)
+            transactions_future = self.executor.submit(self.get_uncategorized_transactions)
+            categories = categories_future.result()
+            transactions = transactions_future.result()
             print(f"   Found {len(categories)} categories")
-            
-            # Fetch uncategorized transactions
-            print("💳 Fetching unapproved transactions...")
-            transactions = self.get_uncategorized_transactions()
             print(f"   Found {len(transactions)} unapproved transactions")
             
             if not transactions:
                 print("✅ No work to do!")
+                self.save_state()  # keep the refreshed YNAB cache
                 # Optionally send a "all clear" message to Slack
                 return
             
@@ -567,16 +682,22 @@ Be concise and accurate. Only use categories from the available list."""
             transfer_pairs, non_transfer_txns = self.detect_transfer_pairs(transactions)
             print(f"   Found {len(transfer_pairs)} transfer pairs, {len(non_transfer_txns)} regular transactions")
             
+            # Account names are only needed to label transfer pairs; fetch them while the AI call runs
+            accounts_future = self.executor.submit(self.get_account_names) if transfer_pairs else None
+            
             # Categorize non-transfer transactions with AI
             if non_transfer_txns:
                 print("🧠 Categorizing with AI...")
                 categorized = self.categorize_with_ai(non_transfer_txns, categories)
+                self.add_display_fields(categorized)
             else:
                 categorized = []
             
+            accounts = accounts_future.result() if accounts_future else {}
+            
             # Send to Slack
             print("💬 Sending to Slack...")
-            ts = self.send_to_slack("", categorized, transfer_pairs)  # Message built in send_to_slack now
+            ts = self.send_to_slack(categorized, categories, transfer_pairs, accounts)
             
             print(f"✅ Sent {len(categorized)} transactions to Slack (ts: {ts})")
             print("   Waiting for user approval...")
@@ -586,6 +707,9 @@ Be concise and accurate. Only use categories from the available list."""
             import traceback
             traceback.print_exc()
             sys.exit(1)
+        finally:
+            self.executor.shutdown()
+            self.session.close()
 
 
 if __name__ == "__main__":
@@ -6,13 +6,13 @@ Quick test script to verify your API keys and connections
 import os
 import requests
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 def test_ynab():
-    """Test YNAB connection"""
+    """Test YNAB connection; returns (passed, message)"""
     token = os.getenv("YNAB_API_TOKEN")
     if not token:
-        print("❌ YNAB_API_TOKEN not set")
-        return False
+        return False, "❌ YNAB_API_TOKEN not set"
     
     try:
         response = requests.get(
@@ -21,22 +21,18 @@ def test_ynab():
         )
         if response.status_code == 200:
             user_id = response.json()["data"]["user"]["id"]
-            print(f"✅ YNAB connected! User ID: {user_id}")
-            return True
+            return True, f"✅ YNAB connected! User ID: {user_id}"
         else:
-            print(f"❌ YNAB error: {response.status_code} - {response.text}")
-            return False
+            return False, f"❌ YNAB error: {response.status_code} - {response.text}"
     except Exception as e:
-        print(f"❌ YNAB connection failed: {e}")
-        return False
+        return False, f"❌ YNAB connection failed: {e}"
 
 
 def test_slack():
-    """Test Slack connection"""
+    """Test Slack connection; returns (passed, message)"""
     token = os.getenv("SLACK_BOT_TOKEN")
     if not token:
-        print("❌ SLACK_BOT_TOKEN not set")
-        return False
+        return False, "❌ SLACK_BOT_TOKEN not set"
     
     try:
         response = requests.post(
@@ -47,22 +43,18 @@ def test_slack():
         if result.get("ok"):
             team = result.get("team")
             user = result.get("user")
-            print(f"✅ Slack connected! Team: {team}, Bot: {user}")
-            return True
+            return True, f"✅ Slack connected! Team: {team}, Bot: {user}"
         else:
-            print(f"❌ Slack error: {result.get('error')}")
-            return False
+            return False, f"❌ Slack error: {result.get('error')}"
     except Exception as e:
-        print(f"❌ Slack connection failed: {e}")
-        return False
+        return False, f"❌ Slack connection failed: {e}"
 
 
 def test_openrouter():
-    """Test OpenRouter connection"""
+    """Test OpenRouter connection; returns (passed, message)"""
     key = os.getenv("OPENROUTER_API_KEY")
     if not key:
-        print("❌ OPENROUTER_API_KEY not set")
-        return False
+        return False, "❌ OPENROUTER_API_KEY not set"
     
     try:
         response = requests.get(
@@ -73,18 +65,15 @@ def test_openrouter():
             data = response.json()["data"]
             limit = data.get("limit", "unknown")
             usage = data.get("usage", 0)
-            print(f"✅ OpenRouter connected! Limit: ${limit}, Used: ${usage}")
-            return True
+            return True, f"✅ OpenRouter connected! Limit: ${limit}, Used: ${usage}"
         else:
-            print(f"❌ OpenRouter error: {response.status_code}")
-            return False
+            return False, f"❌ OpenRouter error: {response.status_code}"
     except Exception as e:
-        print(f"❌ OpenRouter connection failed: {e}")
-        return False
+        return False, f"❌ OpenRouter connection failed: {e}"
 
 
 def test_ynab_categories():
-    """Test fetching YNAB categories"""
+    """Test fetching YNAB categories; returns (passed, message)"""
     token = os.getenv("YNAB_API_TOKEN")
     budget_id = os.getenv("YNAB_BUDGET_ID", "last-used")
     
@@ -96,36 +85,34 @@ def test_ynab_categories():
         if response.status_code == 200:
             groups = response.json()["data"]["category_groups"]
             total = sum(len(g["categories"]) for g in groups)
-            print(f"✅ Found {total} categories in your budget")
-            return True
+            return True, f"✅ Found {total} categories in your budget"
         else:
-            print(f"❌ Could not fetch categories: {response.status_code}")
-            return False
+            return False, f"❌ Could not fetch categories: {response.status_code}"
     except Exception as e:
-        print(f"❌ Category fetch failed: {e}")
-        return False
+        return False, f"❌ Category fetch failed: {e}"
 
 
 if __name__ == "__main__":
     print("🧪 Testing YNAB Slack Agent Setup\n")
     
-    results = []
+    tests = [
+        ("1️⃣ Testing YNAB connection...", test_ynab),
+        ("2️⃣ Testing Slack connection...", test_slack),
+        ("3️⃣ Testing OpenRouter connection...", test_openrouter),
+        ("4️⃣ Testing YNAB categories...", test_ynab_categories),
+    ]
     
-    print("1️⃣ Testing YNAB connection...")
-    results.append(test_ynab())
-    print()
-    
-    print("2️⃣ Testing Slack connection...")
-    results.append(test_slack())
-    print()
-    
-    print("3️⃣ Testing OpenRouter connection...")
-    results.append(test_openrouter())
-    print()
-    
-    print("4️⃣ Testing YNAB categories...")
-    results.append(test_ynab_categories())
-    print()
+    # The checks are independent round-trips, so run them together and print the results in order
+    with ThreadPoolExecutor(max_workers=len(tests)) as pool:
+        futures = [pool.submit(test) for _, test in tests]
+        
+        results = []
+        for (label, _), future in zip(tests, futures):
+            passed, message = future.result()
+            print(label)
+            print(message)
+            print()
+            results.append(passed)
     
     print("=" * 50)
     if all(results):
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+YNAB Agent State Format
+State file, journal and pending-batch files shared by categorize_agent.py and approval_handler.py
+"""
+
+import os
+import glob
+import orjson
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Dict, Iterator, List
+
+# File to store processed transaction IDs and learning data
+STATE_FILE = "/tmp/ynab_agent_state.json"
+# Append-only log of changes approval_handler.py made since STATE_FILE was last written
+JOURNAL_FILE = "/tmp/ynab_agent_state.journal.jsonl"
+# Only the most recent processed transaction ids are kept
+MAX_PROCESSED = 10_000
+# Pending batches nobody acted on are forgotten after this many days
+PENDING_MAX_AGE_DAYS = 14
+# Each batch posted to Slack is stored in its own file, so STATE_FILE only carries a small pointer to it
+PENDING_FILE = "/tmp/ynab_pending_{ts}.json"
+
+
+def read_journal() -> Iterator[Dict]:
+    """Yield the entries in JOURNAL_FILE, oldest first"""
+    if not os.path.exists(JOURNAL_FILE):
+        return
+    with open(JOURNAL_FILE, 'rb') as f:
+        for line in f:
+            try:
+                entry = orjson.loads(line)
+            except ValueError:
+                return  # torn final line from a crash mid-append
+            yield entry
+
+
+def learned_patterns(entry: Dict) -> Dict[str, str]:
+    """Payee -> category pairs in a "learn" entry; older entries hold a single pair"""
+    if "patterns" in entry:
+        return entry["patterns"]
+    return {entry["payee"]: entry["category"]}
+
+
+def apply_journal_entry(state: Dict, entry: Dict):
+    """Apply one journaled state change; replaying an entry twice is harmless"""
+    op = entry["op"]
+    if op == "learn":
+        state["category_patterns"].update(learned_patterns(entry))
+    elif op == "processed":
+        processed = state["processed_transactions"]
+        known = set(processed)
+        processed.extend(tid for tid in entry["ids"] if tid not in known)
+        del processed[:-MAX_PROCESSED]
+    elif op == "resolve":
+        # Mark approved transactions resolved, and drop the batch once all of them are
+        pending = state["pending"].get(entry["ts"])
+        if pending:
+            resolved = pending["resolved"]
+            resolved.extend(tid for tid in entry["ids"] if tid not in resolved)
+            if len(resolved) >= pending["count"]:
+                state["pending"].pop(entry["ts"])
+    elif op == "drop_pending":
+        state["pending"].pop(entry["ts"], None)
+    elif op == "transfers_done":
+        pending = state["pending"].get(entry["ts"])
+        if pending:
+            pending["transfers_done"] = True
+    elif op == "cache":
+        state.setdefault("ynab_cache", {})[entry["key"]] = entry["value"]
+
+
+def write_pending_batch(ts: str, batch: Dict) -> Dict:
+    """Write a batch to its own PENDING_FILE and return the pointer kept for it in state["pending"]"""
+    path = PENDING_FILE.format(ts=ts)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(batch))
+    os.replace(tmp_path, path)
+    return {"file": path, "count": len(batch["transactions"]), "resolved": [], "timestamp": batch["timestamp"]}
+
+
+@lru_cache(maxsize=32)
+def read_pending_batch(path: str) -> Dict:
+    """Load a batch file; they are never rewritten, so the parsed batch is cached"""
+    with open(path, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def index_pending_transactions(state: Dict):
+    """Bring pending batches from older state files up to date: move top-level pending_<ts> keys
+    under state["pending"], and move batches stored inline out to their own PENDING_FILE"""
+    pending = state.setdefault("pending", {})
+    for key in [k for k in state if k.startswith("pending_")]:
+        pending[key[len("pending_"):]] = state.pop(key)
+    for ts, batch in pending.items():
+        if "file" in batch:
+            continue
+        if isinstance(batch["transactions"], list):
+            batch["transactions"] = {t["id"]: t for t in batch["transactions"]}
+        pending[ts] = write_pending_batch(ts, batch)
+
+
+def prune_pending(state: Dict) -> int:
+    """Drop pending batches older than PENDING_MAX_AGE_DAYS, and batch files as old, returning how many batches were dropped"""
+    cutoff = datetime.now() - timedelta(days=PENDING_MAX_AGE_DAYS)
+    stale = [ts for ts, batch in state["pending"].items() if datetime.fromisoformat(batch["timestamp"]) < cutoff]
+    for ts in stale:
+        del state["pending"][ts]
+    # Files of resolved batches are left for this sweep rather than deleted as each batch empties
+    for path in glob.glob(PENDING_FILE.format(ts="*")):
+        try:
+            if os.path.getmtime(path) < cutoff.timestamp():
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+    return len(stale)
+
+
+def merge_category_groups(categories: Dict[str, str], groups: List[Dict]) -> Dict[str, str]:
+    """Apply YNAB category groups (the full list, or only what changed since a server_knowledge) to an id -> name dict"""
+    for group in groups:
+        skip_group = group["name"] in ["Internal Master Category", "Hidden Categories"]
+        for cat in group["categories"]:
+            if skip_group or cat["hidden"] or cat["deleted"]:
+                categories.pop(cat["id"], None)
+            else:
+                categories[cat["id"]] = cat["name"]
+    return categories